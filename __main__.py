@@ -12,67 +12,118 @@ import sys
 from functools import partial
 from importlib import resources
 from pathlib import Path
-from typing import List, Optional
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Coroutine, List, Optional
 
-import munch  # type: ignore
 import typer
-import yaml  # type: ignore
 
 import webcheck
+from webcheck import DEFAULT_INTERVAL
+from webcheck.config import load_yaml_cached
 from webcheck.credentials import get_password
-from webcheck.database import pg_connect_check, pg_create, pg_drop, pg_writer
-from webcheck.kafka import get_kafka_ssl_context
-from webcheck.page import PageCheck
-from webcheck.webchecker import (
-    DEFAULT_INTERVAL,
-    console_writer,
-    consumer_loop,
-    producer_loop,
-    round_trip_loop,
-)
+
+# heavier dependencies (yaml, munch, uvloop, aiokafka, asyncpg, aiohttp) are
+# imported in the commands that need them to keep CLI start up snappy
+if TYPE_CHECKING:
+    import munch  # type: ignore
 
 CONFIG_FILE = Path("webcheck.yaml")
 TOPIC = "my_topic"
 
 
 logging.basicConfig()
-log = logging.getLogger()
+log = logging.getLogger(__name__)
 app = typer.Typer()
 
 
-def get_config(config_path: Optional[Path] = None) -> munch.Munch:
+def run_async(coro: Coroutine) -> Any:
+    """asyncio.run on the libuv based event loop
+
+    Every command drives its work through here.
+    """
+    import uvloop
+
+    uvloop.install()
+    return asyncio.run(coro)
+
+
+def get_config(config_path: Optional[Path] = None) -> "munch.Munch":
     """read config file
 
     In production this would come from say zookeeper or more manageable
     store.
     """
+    import munch  # type: ignore
+
+    from webcheck.kafka import get_kafka_ssl_context
+
     config_file: Path = config_path if config_path is not None else CONFIG_FILE
     config = munch.Munch()
-    with resources.open_text(package=webcheck, resource=config_file) as config_io:
-        config.update(yaml.safe_load(config_io))
+    with resources.as_file(resources.files(webcheck) / str(config_file)) as yaml_path:
+        config.update(load_yaml_cached(yaml_path))
     mconfig = munch.munchify(config)
     mconfig.kafka.ssl = get_kafka_ssl_context()
     return mconfig
 
 
+async def with_pg_writers(
+    service_uri: str,
+    console: bool,
+    run: Callable[[List, List], Awaitable[int]],
+) -> int:
+    """build the writers around a postgres pool and hand them to run
+
+    run is called with (writers, batch_writers). The pool has to be created
+    inside the running loop, it is closed when run returns or is cancelled.
+    """
+    from webcheck.database import pg_pool, pg_writer_many
+    from webcheck.webchecker import console_writer
+
+    async with pg_pool(service_uri) as pool:
+        writers: List = [console_writer] if console else []
+        batch_writers: List = [partial(pg_writer_many, pool)]
+        return await run(writers, batch_writers)
+
+
+async def with_page_checks(
+    sites: List,
+    run: Callable[[List], Awaitable[int]],
+) -> int:
+    """build PageCheck collectors sharing one http session and hand them to run
+
+    Sharing the session keeps connections alive between checks. It has to be
+    created inside the running loop, it is closed when run returns or is
+    cancelled.
+    """
+    from webcheck.page import PageCheck, client_session
+
+    async with client_session() as session:
+        page_checks = [PageCheck(session=session, **site) for site in sites]
+        return await run([pc.check for pc in page_checks])
+
+
 @app.callback()
 def main(log_level: Optional[str] = "INFO"):
     lvl: str = log_level if log_level is not None else "INFO"
-    log.setLevel(lvl)
+    # module loggers inherit their level from the root logger
+    logging.getLogger().setLevel(lvl)
 
 
 @app.command()
 def producer(config_path: Optional[Path] = None, interval: int = DEFAULT_INTERVAL):
     """start long running producer"""
+    from webcheck.webchecker import producer_loop
+
     config = get_config(config_path=config_path)
-    page_checks = [PageCheck(**site) for site in config.sites]
-    rv = asyncio.run(
-        producer_loop(
-            uri=config.kafka.service_uri,
-            topic=config.kafka.topic,
-            ssl_context=config.kafka.ssl,
-            interval=interval,
-            collectors=[pc.check for pc in page_checks],
+    rv = run_async(
+        with_page_checks(
+            sites=config.sites,
+            run=lambda collectors: producer_loop(
+                uri=config.kafka.service_uri,
+                topic=config.kafka.topic,
+                ssl_context=config.kafka.ssl,
+                interval=interval,
+                collectors=collectors,
+            ),
         )
     )
     sys.exit(rv)
@@ -85,21 +136,25 @@ def consumer(
     console: bool = True,
 ):
     """start long running consumer"""
+    from webcheck.webchecker import consumer_loop
+
     config = get_config(config_path=config_path)
     # create pg writer
     pg_service_uri = config.postgresql.service_uri
     pg_username = config.postgresql.username
     pg_password = password or get_password(pg_username, "postgresql")
     uri = pg_service_uri.format(username=pg_username, password=pg_password)
-    writers: List = [partial(pg_writer, uri)]
-    if console:
-        writers.append(console_writer)
-    rv = asyncio.run(
-        consumer_loop(
-            uri=config.kafka.service_uri,
-            topic=config.kafka.topic,
-            ssl_context=config.kafka.ssl,
-            writers=writers,
+    rv = run_async(
+        with_pg_writers(
+            service_uri=uri,
+            console=console,
+            run=lambda writers, batch_writers: consumer_loop(
+                uri=config.kafka.service_uri,
+                topic=config.kafka.topic,
+                ssl_context=config.kafka.ssl,
+                writers=writers,
+                batch_writers=batch_writers,
+            ),
         )
     )
     sys.exit(rv)
@@ -116,24 +171,30 @@ def round_trip(
 
     in a single process for demonstration purposes
     """
+    from webcheck.webchecker import round_trip_loop
+
     config = get_config(config_path=config_path)
-    page_checks = [PageCheck(**site) for site in config.sites]
     # create pg writer
     pg_service_uri = config.postgresql.service_uri
     pg_username = config.postgresql.username
     pg_password = password or get_password(pg_username, "postgresql")
     uri = pg_service_uri.format(username=pg_username, password=pg_password)
-    writers: List = [partial(pg_writer, uri)]
-    if console:
-        writers.append(console_writer)
-    rv = asyncio.run(
-        round_trip_loop(
-            uri=config.kafka.service_uri,
-            topic=config.kafka.topic,
-            ssl_context=config.kafka.ssl,
-            collectors=[pc.check for pc in page_checks],
-            writers=writers,
-            interval=interval,
+    rv = run_async(
+        with_pg_writers(
+            service_uri=uri,
+            console=console,
+            run=lambda writers, batch_writers: with_page_checks(
+                sites=config.sites,
+                run=lambda collectors: round_trip_loop(
+                    uri=config.kafka.service_uri,
+                    topic=config.kafka.topic,
+                    ssl_context=config.kafka.ssl,
+                    collectors=collectors,
+                    writers=writers,
+                    batch_writers=batch_writers,
+                    interval=interval,
+                ),
+            ),
         )
     )
     sys.exit(rv)
@@ -142,8 +203,10 @@ def round_trip(
 @app.command()
 def url_check(url: str = "https://example.com", regex: Optional[str] = None):
     """one shot web page check"""
+    from webcheck.page import PageCheck
+
     pg = PageCheck(url=url, regex=regex)
-    text = asyncio.run(pg.check())
+    text = run_async(pg.check())
     print(text)
 
 
@@ -159,13 +222,15 @@ def pg_service(config_path: Optional[Path] = None, password: Optional[str] = Non
     - environment variable POSTGRES_PASSWORD
     - the user is prompted at the terminal
     """
+    from webcheck.database import pg_connect_check
+
     config = get_config(config_path=config_path)
     service_uri = config.postgresql.service_uri
     username = config.postgresql.username
     password = password or get_password(username, "postgresql")
 
     uri = service_uri.format(username=username, password=password)
-    rv = asyncio.run(pg_connect_check(uri))
+    rv = run_async(pg_connect_check(uri))
     sys.exit(rv)
 
 
@@ -176,13 +241,15 @@ def pg_table_create(config_path: Optional[Path] = None, password: Optional[str]
     Note the tables are lazily created by the service anyway so this is
     more for testing.
     """
+    from webcheck.database import pg_create
+
     config = get_config(config_path=config_path)
     service_uri = config.postgresql.service_uri
     username = config.postgresql.username
     password = password or get_password(username, "postgresql")
 
     uri = service_uri.format(username=username, password=password)
-    rv = asyncio.run(pg_create(uri))
+    rv = run_async(pg_create(uri))
     sys.exit(rv)
 
 
@@ -199,6 +266,7 @@ def pg_table_drop(
 
     password must be supplied on command line.
     """
+    from webcheck.database import pg_drop
 
     config = get_config(config_path=config_path)
     service_uri = config.postgresql.service_uri
@@ -206,7 +274,7 @@ def pg_table_drop(
     if prompt:
         uri = service_uri.format(username=username, password=password)
         log.info(uri)
-        rv = asyncio.run(pg_drop(uri))
+        rv = run_async(pg_drop(uri))
         sys.exit(rv)
 
 
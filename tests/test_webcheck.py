@@ -1,8 +1,17 @@
-from typing import Optional
+import asyncio
+import logging
+import re
+from datetime import date
+from typing import AsyncIterator, List, Optional, Pattern, Union
 
 import pytest
+from aiohttp import web
 
-from webcheck.page import check_regex
+import webcheck.config
+import webcheck.page
+from webcheck.config import load_yaml_cached
+from webcheck.page import PageCheck, check_regex
+from webcheck.webchecker import queue_put, scheduler, writer_wrapper
 
 html = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN"
 "https://www.w3.org/TR/html4/loose.dtd">
@@ -24,7 +33,213 @@ html = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN"
         (html, "example", True),
         (html, "not-a-match", False),
         (html, None, None),
+        (html, re.compile("[eE]xample page"), True),
+        (html, re.compile("not-a-match"), False),
     ],
 )
-def test_regex(text, regex: Optional[str], expected: bool):
+def test_regex(text, regex: Optional[Union[str, Pattern[str]]], expected: bool):
     assert check_regex(text=text, regex=regex) == expected
+
+
+@pytest.mark.parametrize(
+    "regex,expected",
+    [
+        ("[eE]xample page", True),
+        ("not-a-match", False),
+        (r"<(b)>example</\1>", True),
+        # text only patterns fall back to searching the decoded page
+        (r"(?u)\w+ page", True),
+        (r"\u0045xample page", True),
+        (r"\u0045xample site", False),
+        (None, None),
+    ],
+)
+def test_page_check_match(regex: Optional[str], expected: bool):
+    async def chunks() -> AsyncIterator[bytes]:
+        yield html.encode("utf8")
+
+    page_check = PageCheck(url="https://example.com", regex=regex)
+    assert asyncio.run(page_check.match(chunks())) == expected
+
+
+def test_page_check_bad_regex():
+    with pytest.raises(ValueError, match="https://example.com"):
+        PageCheck(url="https://example.com", regex="[unclosed")
+
+
+# served in several CHUNK_SIZE chunks, "ab" straddles the first boundary
+long_page = b"a" + b"b" * 1000 + b"c"
+
+
+async def serve_and_check(regex: str, hyperscan: bool) -> Optional[bool]:
+    async def handler(request: web.Request) -> web.Response:
+        return web.Response(body=long_page)
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        sockets: List = site._server.sockets  # type: ignore
+        port = sockets[0].getsockname()[1]
+        page_check = PageCheck(url=f"http://127.0.0.1:{port}/", regex=regex)
+        if not hyperscan:
+            page_check._hs_db = None
+        metrics = await page_check.check()
+        return metrics.regex_matched
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.parametrize(
+    "hyperscan",
+    [
+        pytest.param(
+            True,
+            marks=pytest.mark.skipif(
+                webcheck.page.hyperscan is None, reason="hyperscan not installed"
+            ),
+        ),
+        False,
+    ],
+)
+@pytest.mark.parametrize(
+    "regex,expected",
+    [
+        ("ab{100}", True),
+        ("b{100}c$", True),
+        ("^b+", False),
+        ("^ab+c$", True),
+        ("^b{10}(?!b)", False),
+        ("not-a-match", False),
+    ],
+)
+def test_page_check_chunked(monkeypatch, regex: str, expected: bool, hyperscan: bool):
+    monkeypatch.setattr(webcheck.page, "CHUNK_SIZE", 64)
+    assert asyncio.run(serve_and_check(regex, hyperscan)) == expected
+
+
+def test_writer_wrapper_batches():
+    written: List = []
+    batches: List[List] = []
+
+    async def writer(payload):
+        written.append(payload)
+
+    async def batch_writer(payloads):
+        batches.append(list(payloads))
+
+    async def run():
+        queue: asyncio.Queue = asyncio.Queue()
+        for i in range(7):
+            queue.put_nowait(i)
+        task = asyncio.create_task(
+            writer_wrapper(queue, [writer], [batch_writer], batch_size=3, linger=0.05)
+        )
+        await asyncio.sleep(0.1)
+        # a lone payload goes out once linger passes
+        queue.put_nowait(7)
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert written == list(range(8))
+    assert batches == [[0, 1, 2], [3, 4, 5], [6], [7]]
+
+
+def test_load_yaml_cached(monkeypatch, tmp_path):
+    monkeypatch.setattr(webcheck.config, "CACHE_DIR", tmp_path / "cache")
+    a = tmp_path / "a" / "webcheck.yaml"
+    b = tmp_path / "b" / "webcheck.yaml"
+    for path, site in ((a, "a"), (b, "b")):
+        path.parent.mkdir()
+        path.write_text(f"sites: [{site}]\n")
+    # same file name in two places, each gets its own data
+    assert load_yaml_cached(a) == {"sites": ["a"]}
+    assert load_yaml_cached(b) == {"sites": ["b"]}
+    assert load_yaml_cached(a) == {"sites": ["a"]}
+    assert len(list((tmp_path / "cache").glob("webcheck-*.json"))) == 2
+
+    # cache hit, the yaml isn't parsed again
+    import yaml  # type: ignore
+
+    def no_parse(*args, **kwargs):
+        raise AssertionError("yaml parsed")
+
+    monkeypatch.setattr(yaml, "load", no_parse)
+    assert load_yaml_cached(b) == {"sites": ["b"]}
+
+    # stale entry, edited yaml is parsed
+    monkeypatch.undo()
+    monkeypatch.setattr(webcheck.config, "CACHE_DIR", tmp_path / "cache")
+    b.write_text("sites: [c]\n")
+    assert load_yaml_cached(b) == {"sites": ["c"]}
+
+
+def test_load_yaml_cached_no_round_trip(monkeypatch, tmp_path):
+    monkeypatch.setattr(webcheck.config, "CACHE_DIR", tmp_path / "cache")
+    path = tmp_path / "webcheck.yaml"
+    path.write_text("day: 2021-06-01\n1: one\n")
+    assert load_yaml_cached(path) == {"day": date(2021, 6, 1), 1: "one"}
+    assert load_yaml_cached(path) == {"day": date(2021, 6, 1), 1: "one"}
+    assert not list((tmp_path / "cache").glob("*"))
+
+
+def test_scheduler_slow_collector():
+    calls = {"fast": 0, "slow": 0}
+
+    async def fast():
+        calls["fast"] += 1
+        return "fast"
+
+    async def slow():
+        calls["slow"] += 1
+        await asyncio.sleep(10)
+        return "slow"
+
+    async def run() -> List:
+        queue: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(scheduler(queue, [slow, fast], interval=0.05))
+        await asyncio.sleep(0.22)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    results = asyncio.run(run())
+    # the hanging collector neither holds up nor piles up behind the other
+    assert calls["slow"] == 1
+    assert calls["fast"] >= 4
+    assert results == ["fast"] * calls["fast"]
+
+
+def test_scheduler_collector_error():
+    async def broken():
+        raise RuntimeError("broken")
+
+    async def run():
+        await scheduler(asyncio.Queue(), [broken], interval=0.01)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+
+
+def test_queue_put_high_water(caplog):
+    async def run():
+        queue: asyncio.Queue = asyncio.Queue(maxsize=10)
+        for i in range(10):
+            await queue_put(queue, i, "test")
+        while queue.qsize() > 2:
+            queue.get_nowait()
+        for i in range(8):
+            await queue_put(queue, i, "test")
+
+    with caplog.at_level(logging.INFO, logger="webcheck.webchecker"):
+        asyncio.run(run())
+    # one warning per excursion above the mark, not one per put
+    warnings = [r for r in caplog.records if r.levelno == logging.WARNING]
+    assert len(warnings) == 2
@@ -1 +1,5 @@
 __version__ = "0.1.0"
+
+# seconds between page checks, here so the CLI can use it as an option
+# default without importing the kafka machinery
+DEFAULT_INTERVAL = 15
@@ -0,0 +1,59 @@
+#!/bin/env python3
+
+"""
+config file loading
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = Path(os.getenv("XDG_CACHE_HOME", Path.home() / ".cache")) / "webcheck"
+
+
+def load_yaml_cached(yaml_path: Path) -> dict:
+    """load yaml file via a json copy in CACHE_DIR
+
+    json parses far faster than PyYAML so the yaml is only parsed when there
+    is no cached copy of its contents. Cache entries are keyed on a hash of
+    the yaml bytes so installs with different configs never share one and
+    edits or temporary copies (eg of a zipped resource) need no mtime checks.
+    Data json can't round trip (dates, non string keys) is not cached.
+    Failing to write the cache is not fatal.
+    """
+    import yaml  # type: ignore
+
+    content = yaml_path.read_bytes()
+    key = hashlib.sha1(content).hexdigest()[:16]
+    cache_path = CACHE_DIR / f"{yaml_path.stem}-{key}.json"
+    try:
+        with cache_path.open() as cache_io:
+            return json.load(cache_io)
+    except (OSError, ValueError):
+        pass
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    data = yaml.load(content, Loader=loader)
+    try:
+        text = json.dumps(data)
+        if json.loads(text) != data:
+            log.debug("config cache not written: %s doesn't round trip", yaml_path)
+            return data
+    except (TypeError, ValueError) as ex:
+        log.debug("config cache not written: %s", ex)
+        return data
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_text(text)
+        os.replace(tmp_path, cache_path)
+    except OSError as ex:
+        log.debug("config cache not written: %s", ex)
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+    return data
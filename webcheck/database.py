@@ -7,6 +7,7 @@ Also has some high level functions for CLI utilities.
 """
 
 import logging
+from typing import List, Tuple
 
 import asyncpg  # type: ignore
 
@@ -14,17 +15,19 @@ import asyncpg  # type: ignore
 from webcheck.webchecker import ConsumerPayload
 
 logging.basicConfig()
-log = logging.getLogger()
+log = logging.getLogger(__name__)
 
 DEFAULT_TIMEOUT = 30
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 10
 # get this from yaml with place holders for username and password
 PG_SERVICE_URI = "postgres://{}:{}@{pg_host}:18584/defaultdb?sslmode=require"
 TABLE_NAME = "webcheck"
 TIME_FIELD = "time"
 
 # @todo: compose SQL from PageMetrics schema
-# for now we hand code it taking care the
-# field ordering is the same as PageMetrics
+# for now we hand code it, pg_row picks the PageMetrics
+# fields by name in the same order as the insert parameters
 
 SQL_CREATE = f"""
 CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
@@ -51,46 +54,72 @@ INSERT INTO {TABLE_NAME} (
 )
 """
 
+# batches are written atomically so a duplicate row must not take the
+# rest of the batch down with it
+SQL_INSERT_MANY = f"""{SQL_INSERT.rstrip()}
+ON CONFLICT ({TIME_FIELD}, url) DO NOTHING
+"""
+
 SQL_DROP = f"DROP TABLE IF EXISTS {TABLE_NAME};"
 
 
-async def pg_writer(service_uri: str, payload: ConsumerPayload) -> int:
-    """write page metrics to table
+def pg_row(payload: ConsumerPayload) -> Tuple:
+    """PageMetrics as SQL_INSERT parameters"""
+    return (
+        payload.time,
+        payload.url,
+        payload.status,
+        payload.response_time,
+        payload.regex_matched,
+    )
+
+
+def pg_pool(service_uri: str) -> asyncpg.pool.Pool:
+    """connection pool shared by the writers
+
+    Use as `async with pg_pool(service_uri) as pool:` so the connections
+    are established inside the running loop and closed on the way out.
 
     Args:
         service_uri: pg dsn
-        payload: this is the form the data comes to the writer in. Ideally
-            it would be a PageMetrics instances but we would need to serialize
-            the dataclass symmetrically over the bytes messaging content
-            of kafka. We have cheated here by deliberately encode/decode
-            as a Tuple and as long as the fields line up between
-            PageMetrics -> ConsumerPayload -> insert_sql we are good.
-
-    This is a one-shot writer, connections are created for each
-    write. For higher throughput applications re-using the connection
-    could be a better idea.
+    """
+    return asyncpg.create_pool(
+        service_uri,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        command_timeout=DEFAULT_TIMEOUT,
+        timeout=DEFAULT_TIMEOUT,
+    )
+
+
+async def pg_writer_many(pool: asyncpg.pool.Pool, payloads: List[ConsumerPayload]) -> int:
+    """write a batch of page metrics to table in one round trip
+
+    Batch writer for writer_wrapper. Connections are borrowed from the pool
+    rather than paying a TCP + TLS + auth handshake per batch. Rows that
+    already exist are skipped. executemany runs the whole batch through one
+    prepared statement, which asyncpg keeps in each connection's statement
+    cache so a pooled connection parses SQL_INSERT_MANY only once (unless
+    the cache is disabled, eg behind pgbouncer in transaction mode).
+
+    Args:
+        pool: connection pool, see pg_pool. Curry it in with functools.partial
+            to make a batch writer.
+        payloads: PageMetrics decoded from kafka, fields are mapped to
+            insert parameters by pg_row.
     """
     try:
-        connection: asyncpg.Connection = await asyncpg.connect(
-            service_uri, timeout=DEFAULT_TIMEOUT
-        )
-        log.debug("writer: successful connection to postgresql service")
-        sql = SQL_INSERT
-        log.debug(sql)
-        await connection.execute(
-            sql,
-            *payload,
-            timeout=DEFAULT_TIMEOUT,
-        )
-        log.info(f"pg_writer: written {payload}")
-        await connection.close(timeout=DEFAULT_TIMEOUT)
-    except asyncpg.exceptions.UniqueViolationError:
-        log.warning("unique key error @todo tidy up kafka consumer")
+        async with pool.acquire(timeout=DEFAULT_TIMEOUT) as connection:
+            await connection.executemany(
+                SQL_INSERT_MANY,
+                [pg_row(payload) for payload in payloads],
+                timeout=DEFAULT_TIMEOUT,
+            )
+        log.info("pg_writer_many: written %i rows", len(payloads))
     except Exception:
         log.error("failure: postgresql connect - the pg-table-create command might help")
-        # if we get insert errors lets just bail out.
         raise
-    return 0
+    return len(payloads)
 
 
 async def pg_connect_check(service_uri: str) -> bool:
@@ -107,7 +136,7 @@ async def pg_connect_check(service_uri: str) -> bool:
         await connection.close()
         return True
     except Exception as ex:
-        log.error(f"failure: postgresql connect {ex}")
+        log.error("failure: postgresql connect %s", ex)
     return False
 
 
@@ -5,6 +5,7 @@ create ssl.SSLContext for kafka clients.
 """
 
 import logging
+from functools import lru_cache
 from importlib import resources
 from pathlib import Path
 from ssl import SSLContext
@@ -14,7 +15,7 @@ from aiokafka.helpers import create_ssl_context  # type: ignore
 import webcheck
 
 logging.basicConfig()
-log = logging.getLogger()
+log = logging.getLogger(__name__)
 
 
 CAFILE = Path("ca.pem")
@@ -22,24 +23,27 @@ CERTFILE = Path("service.cert")
 KEYFILE = Path("service.key")
 
 
+@lru_cache(maxsize=1)
 def get_kafka_ssl_context() -> SSLContext:
     """get kafka ssl context
 
     For this exercise we are packaging the ssl files in the python package.
     In real life these would come from some secure configuration - eg
     zookeeper.
+
+    The context is built once and shared, SSLContext is safe to reuse
+    across clients.
     """
-    with resources.path(package=webcheck, resource=CAFILE) as _cafile:
-        # these are the default locations for the ssl files, stored in
-        # package
-        cafile = Path(_cafile)
-        certfile = cafile.parent / CERTFILE
-        keyfile = cafile.parent / KEYFILE
-
-    context = create_ssl_context(
-        cafile=cafile,
-        certfile=certfile,
-        keyfile=keyfile,
-        password=None,
-    )
+    ssl_files = resources.files(webcheck)
+    # the CA is loaded from memory, load_cert_chain only takes file paths
+    # so as_file() only stages copies when the package is zipped
+    with resources.as_file(ssl_files / str(CERTFILE)) as certfile, resources.as_file(
+        ssl_files / str(KEYFILE)
+    ) as keyfile:
+        context = create_ssl_context(
+            cadata=(ssl_files / str(CAFILE)).read_text(),
+            certfile=certfile,
+            keyfile=keyfile,
+            password=None,
+        )
     return context
@@ -6,31 +6,138 @@ Collect metrics from arbitrary URLs
 
 import logging
 import re
-from time import time
-from typing import Dict, Optional
+from time import monotonic, time
+from typing import AsyncIterator, Dict, List, Optional, Pattern, Union
 
 import aiohttp
 
 from webcheck.schema import PageMetrics
 
-# using root logger for all modules
-log = logging.getLogger()
+log = logging.getLogger(__name__)
 
+# page bodies are read and regex scanned this many bytes at a time
+CHUNK_SIZE = 16384
+# bytes carried between chunks so matches straddling a chunk boundary
+# are found by re, matches longer than this may be missed.
+MIN_OVERLAP = 1024
+# anchors and lookaround depend on where the scanned window starts so re
+# patterns using them (or anything resembling them) see the whole body.
+CONTEXT_SENSITIVE = re.compile(r"[\^$]|\\[AZbB]|\(\?<?[=!]")
+# connection pool limits for the shared http session
+CONNECTION_LIMIT = 64
+DNS_CACHE_TTL = 300
 
-def check_regex(text: str, regex: Optional[str] = None) -> Optional[bool]:
-    """applies regex check on page text"""
+try:
+    import hyperscan  # type: ignore
+except ImportError:
+    log.debug("no hyperscan module installed, regex checks use re.")
+    hyperscan = None  # type: ignore
+
+
+def check_regex(
+    text: str, regex: Union[str, Pattern[str], None] = None
+) -> Optional[bool]:
+    """applies regex check on page text
+
+    regex may be a pattern string or a pre-compiled pattern.
+    """
     if not regex:
         return None
-    return bool(re.search(regex, text))
+    if isinstance(regex, str):
+        regex = re.compile(regex)
+    return regex.search(text) is not None
+
+
+def compile_hyperscan(regex: str) -> Optional["hyperscan.Database"]:
+    """compile regex into a hyperscan stream mode database
+
+    Stream mode carries match state from one chunk to the next so anchors
+    and matches straddling chunks behave as if the body was scanned whole.
+
+    Returns None when hyperscan is not installed or cannot compile the pattern
+    (eg back references, patterns matching the empty string) - callers fall
+    back to re.
+    """
+    if hyperscan is None:
+        return None
+    db = hyperscan.Database(mode=hyperscan.HS_MODE_STREAM)
+    try:
+        db.compile(
+            expressions=[regex.encode("utf8")],
+            flags=[hyperscan.HS_FLAG_SINGLEMATCH],
+        )
+    except hyperscan.error as ex:
+        log.info("hyperscan can't compile %r, using re: %s", regex, ex)
+        return None
+    return db
+
+
+async def hyperscan_search(
+    db: "hyperscan.Database", chunks: AsyncIterator[bytes]
+) -> bool:
+    """True if the pattern compiled into db matches anywhere in chunks
+
+    All the chunks are consumed, scanning stops at the first match.
+    """
+    matches: List = []
+
+    def on_match(*match):
+        matches.append(match)
+
+    # the handler is passed to scan too, the stream does not keep it alive
+    with db.stream(match_event_handler=on_match) as stream:
+        async for chunk in chunks:
+            if not matches:
+                stream.scan(chunk, match_event_handler=on_match)
+    return bool(matches)
+
+
+async def regex_search(
+    regex: Pattern[bytes], chunks: AsyncIterator[bytes], overlap: int
+) -> bool:
+    """True if regex matches anywhere in chunks
+
+    Each chunk is searched together with the last overlap bytes before it,
+    so matches up to overlap bytes long that straddle chunks are found.
+    All the chunks are consumed, scanning stops at the first match.
+    """
+    matched = regex.search(b"") is not None
+    tail = b""
+    async for chunk in chunks:
+        if not matched:
+            window = tail + chunk
+            matched = regex.search(window) is not None
+            start = max(0, len(window) - overlap)
+            tail = window[start:]
+    return matched
+
+
+def client_session() -> aiohttp.ClientSession:
+    """http session to share between PageChecks
+
+    Use as `async with client_session() as session:` inside the running loop.
+    Connections (and their TLS sessions) are kept alive between checks.
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT, ttl_dns_cache=DNS_CACHE_TTL
+        )
+    )
 
 
 class PageCheck:
     """check webpage
 
-    For this application setup up new session per request.
+    Pass a shared session (see client_session) for long running use, without
+    one a new session is set up per request.
 
     - instantiate a PageCheck per url
     - call check, response is returned as PageMetrics instance
+
+    The regex is applied to the raw response bytes as they stream in rather
+    than the decoded text so it should stick to ascii. Patterns that only
+    compile as text (eg (?u) or \\u escapes) are searched against the whole
+    decoded body instead.
     """
 
     def __init__(
@@ -39,47 +146,112 @@ class PageCheck:
         query_parms: Optional[Dict] = None,
         regex: Optional[str] = None,
         http_timeout: int = 30,
+        session: Optional[aiohttp.ClientSession] = None,
     ):
         """
         Args:
 
             url: page to check
             query_parms: optional query parameters
-            regex: optional regex pattern
+            regex: optional regex pattern. Without hyperscan, matches longer
+                than max(len(regex), MIN_OVERLAP) bytes may be missed unless the
+                pattern uses anchors or lookaround, those search the whole body.
+                Raises ValueError naming the url if the pattern doesn't compile.
             http_timeout: end to end timeout in seconds
+            session: optional shared http session, owned by the caller
         """
         self.url = url
         self.query_parms = query_parms
         self.regex = regex
+        self._regex: Optional[Pattern[bytes]] = None
+        self._text_regex: Optional[Pattern[str]] = None
+        if regex:
+            try:
+                self._regex = re.compile(regex.encode("utf8"))
+            except re.error:
+                try:
+                    self._text_regex = re.compile(regex)
+                except re.error as ex:
+                    raise ValueError(f"{url}: bad regex {regex!r}: {ex}") from ex
+                log.info("%s: regex %r searches decoded text", url, regex)
+        self._overlap = max(len(regex), MIN_OVERLAP) if regex else 0
+        self._whole_body = bool(regex and CONTEXT_SENSITIVE.search(regex))
+        # hyperscan's DFA scans large pages much faster than re backtracking
+        self._hs_db = compile_hyperscan(regex) if regex and self._regex else None
         self.http_timeout = http_timeout
         self.timeout = aiohttp.ClientTimeout(total=self.http_timeout)
+        self.session = session
+
+    async def match(
+        self, chunks: AsyncIterator[bytes], encoding: str = "utf8"
+    ) -> Optional[bool]:
+        """applies regex check on page bytes as they arrive
+
+        All the chunks are consumed. None if there is no regex. encoding is
+        only used for text patterns.
+        """
+        if self._hs_db is not None:
+            return await hyperscan_search(self._hs_db, chunks)
+        if self._text_regex is not None:
+            body = [chunk async for chunk in chunks]
+            text = b"".join(body).decode(encoding, errors="replace")
+            return self._text_regex.search(text) is not None
+        if self._regex is None:
+            async for _ in chunks:
+                pass
+            return None
+        if self._whole_body:
+            body = [chunk async for chunk in chunks]
+            return self._regex.search(b"".join(body)) is not None
+        return await regex_search(self._regex, chunks, self._overlap)
 
     async def check(self) -> PageMetrics:
         """check page and return metrics
 
         This takes no args and is designed to be passed to consumer_loop as a writer.
         """
-        metrics: PageMetrics
-        start_time = time()
+        if self.session is not None:
+            return await self._check(self.session)
         async with aiohttp.ClientSession(timeout=self.timeout) as session:
-            try:
-                async with session.get(
-                    self.url,
-                    timeout=self.timeout,
-                    params=self.query_parms,
-                ) as response:
-                    text = await response.text()
-                    end_time = time()
-                    regex_matched = check_regex(text, self.regex)
-                    metrics = PageMetrics(
-                        time=int(end_time),
-                        url=self.url,
-                        status=response.status,
-                        response_time=round(end_time - start_time, 3),
-                        regex_matched=regex_matched,
+            return await self._check(session)
+
+    async def _check(self, session: aiohttp.ClientSession) -> PageMetrics:
+        """check page using session"""
+        metrics: PageMetrics
+        # monotonic for the duration, wall clock only for the timestamp
+        start_time = monotonic()
+        try:
+            async with session.get(
+                self.url,
+                timeout=self.timeout,
+                params=self.query_parms,
+            ) as response:
+                debug = log.isEnabledFor(logging.DEBUG)
+                body: List[bytes] = []
+
+                async def chunks() -> AsyncIterator[bytes]:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        if debug:
+                            body.append(chunk)
+                        yield chunk
+
+                # match reads the body through regardless of a match so
+                # response_time always covers the whole page
+                regex_matched = await self.match(chunks(), response.charset or "utf8")
+                end_time = monotonic()
+                metrics = PageMetrics(
+                    time=int(time()),
+                    url=self.url,
+                    status=response.status,
+                    response_time=round(end_time - start_time, 3),
+                    regex_matched=regex_matched,
+                )
+                if debug:
+                    text = b"".join(body).decode(
+                        response.charset or "utf8", errors="replace"
                     )
-                    log.debug(f"response text: `{text}``")
-                    return metrics
-            except Exception:
-                log.exception("PageCheck: exception - exiting")
-                raise
+                    log.debug("response text: `%s``", text)
+                return metrics
+        except Exception:
+            log.exception("PageCheck: exception - exiting")
+            raise
@@ -5,13 +5,17 @@
 Schema for data we collect and write
 """
 
-from dataclasses import dataclass
 from typing import Optional
 
+import msgspec
 
-@dataclass
-class PageMetrics:
-    """schema for page result"""
+
+class PageMetrics(msgspec.Struct):
+    """schema for page result
+
+    A msgspec Struct so it can be sent over kafka as msgpack and decoded
+    back into a PageMetrics at the consumer.
+    """
 
     time: float
     url: str
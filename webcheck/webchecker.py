@@ -23,85 +23,177 @@ The kafka group_id is hardwired here.
 """
 
 import asyncio
-import json
 import logging
-import time
-from dataclasses import astuple
 from ssl import SSLContext
-from typing import Awaitable, Callable, List, Tuple
+from typing import Awaitable, Callable, Dict, List, Optional, Set
 
+import msgspec
 from aiokafka import AIOKafkaConsumer, AIOKafkaProducer  # type: ignore
 
-from webcheck.page import PageMetrics
+from webcheck import DEFAULT_INTERVAL
+from webcheck.schema import PageMetrics
 
 # signal the consumer to end gracefully
 EOT = b"0x04"
-DEFAULT_INTERVAL = 15
 DEFAULT_GROUP_ID = "webchecker"
+# batch writers are flushed at this many payloads or after linger seconds
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_LINGER = 0.2
+# unacknowledged kafka sends the encoder allows before waiting on delivery
+DEFAULT_MAX_PENDING = 100
+# internal queues are bounded so a stalled kafka or postgres pushes back on
+# the collectors / kafka fetch instead of growing memory, warn when the
+# depth passes the high water mark fraction of this.
+DEFAULT_QUEUE_SIZE = 1024
+QUEUE_HIGH_WATER = 0.8
+# names of the queues currently above the high water mark
+_over_high_water: Set[str] = set()
 
 # Use this for type pushed in internal queue at the consumer.
-# at the producer end we can send page_metrics as is but since
-# we have to encode that as bytes over kafka this is not
-# symetrical for
-ConsumerPayload = Tuple
+# PageMetrics are sent as msgpack and decoded back to PageMetrics
+# so this is symmetrical with the producer end.
+ConsumerPayload = PageMetrics
 
-log = logging.getLogger()
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder(PageMetrics)
 
+log = logging.getLogger(__name__)
 
-async def scheduler(
+
+def use_eager_tasks() -> None:
+    """run new tasks eagerly on the running loop where supported (Python 3.12+)
+
+    Writers and collectors often complete without suspending, eager tasks
+    skip the round trip through the loop's ready queue for those.
+
+    This is a no-op with the locked dependencies, several of them (asyncpg,
+    aiokafka, uvloop) predate Python 3.12. It takes effect once they are
+    upgraded.
+    """
+    eager_task_factory = getattr(asyncio, "eager_task_factory", None)
+    if eager_task_factory is not None:
+        asyncio.get_running_loop().set_task_factory(eager_task_factory)
+
+
+async def queue_put(queue: asyncio.Queue, payload, name: str) -> None:
+    """push payload onto bounded queue, warn if it is backing up
+
+    The warning is logged once when the depth crosses the high water mark,
+    not on every put, and re-armed once the depth drops back below it.
+    Blocks while the queue is full.
+    """
+    if queue.maxsize:
+        high = queue.qsize() > QUEUE_HIGH_WATER * queue.maxsize
+        if high and name not in _over_high_water:
+            _over_high_water.add(name)
+            log.warning("%s: queue depth %i of %i", name, queue.qsize(), queue.maxsize)
+        elif not high and name in _over_high_water:
+            _over_high_water.discard(name)
+            log.info("%s: queue depth back to %i", name, queue.qsize())
+    await queue.put(payload)
+
+
+async def collect(
     queue: asyncio.Queue[PageMetrics],
     collector: Callable[[], Awaitable[PageMetrics]],
-    interval: int = DEFAULT_INTERVAL,
+    i: int,
+) -> None:
+    """run collector once and push its result to the queue"""
+    payload = await collector()
+    log.info("loop %i %s", i, payload)
+    await queue_put(queue, payload, "scheduler")
+
+
+async def scheduler(
+    queue: asyncio.Queue[PageMetrics],
+    collectors: List[Callable[[], Awaitable[PageMetrics]]],
+    interval: float = DEFAULT_INTERVAL,
 ) -> int:
-    """long running collection loop for a single collector
+    """long running collection loop for all the collectors
 
-    Each interval seconds, result of collector() is pushed to the queue.
-    Spin up one of these for each page to be checked.
+    Each interval seconds, all the collectors are started concurrently and
+    each result is pushed to the queue as soon as its collector returns, so
+    a slow page does not hold the others back. A collector still running
+    from an earlier tick is skipped for this one rather than piling up.
 
     This is what drives the whole system.
 
+    Deadlines are kept on the loop's monotonic clock and advanced by interval
+    each time, so the time spent in the collectors does not push later checks
+    back. A collector that raised fails the scheduler at the next tick.
+
     Args:
         queue: python data is pushed here towards encoder
-        collector: takes no args, returns application specific data.
+        collectors: each takes no args, returns application specific data.
+        interval: seconds between collections
     """
+    loop = asyncio.get_running_loop()
+    running: Dict[int, asyncio.Task] = {}
+    next_deadline = loop.time()
     i = 0
-    while True:
-        # this is a very rudimentary scheduling scheme ;)
-        delta = interval - time.time() % interval
-        log.info("next event in %i seconds", delta)
-        # sleep till next check time
-        await asyncio.sleep(delta)
-        payload = await collector()
-        log.info("loop %i %s", i, payload)
-        await queue.put(payload)
-        i += 1
+    try:
+        while True:
+            if next_deadline < loop.time() - interval:
+                # the loop was held up, skip the missed checks rather than burst
+                log.warning("scheduler: overran interval %i", interval)
+                while next_deadline < loop.time():
+                    next_deadline += interval
+            delta = max(0.0, next_deadline - loop.time())
+            log.info("next event in %i seconds", delta)
+            # sleep till next check time
+            await asyncio.sleep(delta)
+            next_deadline += interval
+            for n, collector in enumerate(collectors):
+                task = running.get(n)
+                if task is not None and not task.done():
+                    log.warning("scheduler: collector %i still running, skipped", n)
+                    continue
+                if task is not None:
+                    # re-raises the collector's exception, if any
+                    task.result()
+                running[n] = asyncio.create_task(collect(queue, collector, i))
+            i += 1
+    finally:
+        for task in running.values():
+            task.cancel()
     return 0
 
 
 async def encoder(
-    queue: asyncio.Queue[PageMetrics], producer: AIOKafkaProducer, topic: str
+    queue: asyncio.Queue[PageMetrics],
+    producer: AIOKafkaProducer,
+    topic: str,
+    max_pending: int = DEFAULT_MAX_PENDING,
 ) -> int:
     """
     Waits on queue for incoming python objects, encodes them and publishes.
 
-    Cheating here a little by encoding page metrics as a tuple.
-    In real life we would probably use thrift or proto buf
-    to serialize. pickle would be another option for perfect symmetry on
-    producer consumer ends but would lock us into Python.
+    Page metrics are serialized as msgpack via msgspec, the consumer decodes
+    them straight back into PageMetrics. Unlike pickle this does not lock
+    the consumer into Python.
 
-    astuple() is not a random accident - it anticipates being passed
-    to a postgres execute query but in a more generic world we could not
-    make this assumption.
+    Sends are not awaited one by one, that would hold every message up for
+    a broker round trip. Delivery futures are collected and awaited once
+    max_pending have built up or the queue runs dry, which is where send
+    errors surface.
 
     Args:
         queue: source for application objects - PageMetrics in this case.
         producer: kafka producer client
         topic: kafka topic
+        max_pending: max unacknowledged sends before waiting on delivery
     """
+    pending: List[asyncio.Future] = []
     while True:
         payload: PageMetrics = await queue.get()
-        bpayload = json.dumps(astuple(payload)).encode("utf8")
-        await producer.send_and_wait(topic, bpayload)
+        bpayload = _encoder.encode(payload)
+        # send() only appends to the producer's batch accumulator, the
+        # client ships batches when full or after linger_ms
+        pending.append(await producer.send(topic, bpayload))
+        if len(pending) >= max_pending or queue.empty():
+            await asyncio.gather(*pending)
+            log.debug("encoder: %i messages delivered", len(pending))
+            pending.clear()
 
 
 async def producer_loop(
@@ -116,7 +208,7 @@ async def producer_loop(
     This is one of the two key entry points for the application (user
     interaction notwithstanding).
 
-    Abstractly, it schedules each collector and then marshals the output onto
+    Abstractly, it schedules the collectors and then marshals the output onto
     a kafka producer client.
 
     It coordinates:
@@ -132,8 +224,9 @@ async def producer_loop(
     Collectors take no arguments - so either use a method from a class or make use
     of functool.partial to curry parameters (in our case, urls and regexes)
 
-    - scheduler: the producer_loop wraps each collector in a scheduler which runs
-    the collector at regular intervals and pushes python objects onto an asyncio.Queue.
+    - scheduler: starts all the collectors concurrently at regular intervals and
+    pushes the python objects they return onto an asyncio.Queue as each completes.
+    Results arriving close together share a kafka batch through linger_ms.
 
     - encoder: listens on collector queue, encodes the collector objects and publishes
     them to the kafka publisher client.
@@ -147,19 +240,27 @@ async def producer_loop(
             returns application data as a python object.
     """
     log.info("producer starting")
+    use_eager_tasks()
     if len(collectors) < 1:
         raise ValueError("At least one collector must be passed to producer_loop")
-    queue: asyncio.Queue[PageMetrics] = asyncio.Queue()
-    collector_coros = [
-        scheduler(queue=queue, collector=c, interval=interval) for c in collectors
-    ]
+    queue: asyncio.Queue[PageMetrics] = asyncio.Queue(maxsize=DEFAULT_QUEUE_SIZE)
     async with AIOKafkaProducer(
         bootstrap_servers=uri,
         security_protocol="SSL",
         ssl_context=ssl_context,
+        # trade a little latency for fewer, compressed produce requests
+        linger_ms=100,
+        max_batch_size=64000,
+        compression_type="lz4",
+        # no duplicates from producer retries, idempotence requires acks="all"
+        enable_idempotence=True,
+        acks="all",
     ) as producer:
-        # kick off one encoder and n schedulers
-        rv = await asyncio.gather(encoder(queue, producer, topic), *collector_coros)
+        # kick off one encoder and the scheduler
+        rv = await asyncio.gather(
+            encoder(queue, producer, topic),
+            scheduler(queue=queue, collectors=collectors, interval=interval),
+        )
     log.info("producer exiting %s", rv)
     return 0
 
@@ -170,8 +271,8 @@ async def decoder(
 ) -> int:
     """dispatches messages from subscribed topic and pushes them to writers.
 
-    Analagous to encoder on produce side although not a perfect mirror image
-    due to the basic encoding used.
+    Mirror image of encoder on produce side. Messages that do not decode
+    into PageMetrics are logged and skipped.
 
     Args:
         queue: comms between decoder and writers
@@ -193,8 +294,12 @@ async def decoder(
                 msg.timestamp,
             )
             bpayload: bytes = msg.value
-            payload: ConsumerPayload = json.loads(bpayload)
-            await queue.put(payload)
+            try:
+                payload: ConsumerPayload = _decoder.decode(bpayload)
+            except msgspec.DecodeError as ex:
+                log.warning("decoder: skipping undecodable message %s", ex)
+                continue
+            await queue_put(queue, payload, "decoder")
     except Exception:
         log.exception("decoder: exception")
     log.info("decoder: exiting")
@@ -204,6 +309,11 @@ async def decoder(
 async def writer_wrapper(
     queue: asyncio.Queue[ConsumerPayload],
     writers: List[Callable[[ConsumerPayload], Awaitable[int]]],
+    batch_writers: Optional[
+        List[Callable[[List[ConsumerPayload]], Awaitable[int]]]
+    ] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    linger: float = DEFAULT_LINGER,
 ) -> int:
     """waits on decoded data and invokes each writer
 
@@ -212,11 +322,34 @@ async def writer_wrapper(
         writers: each writer gets called with a the data consumed
             from the queue. Note these are not copied so writers
             should not mutate them directly.
+        batch_writers: each batch writer gets called with a list of payloads,
+            collected until batch_size is reached or linger seconds have
+            passed since the first payload of the batch. Same rules about
+            mutating apply.
+        batch_size: max payloads passed to a batch writer in one call
+        linger: max seconds a payload waits for the batch to fill
     """
+    loop = asyncio.get_running_loop()
+    batch_writers = batch_writers or []
     while True:
         payload = await queue.get()
-        log.info("writer_wrapper[%s]: %s", len(writers), payload)
-        await asyncio.gather(*[writer(payload) for writer in writers])
+        batch: List[ConsumerPayload] = [payload]
+        deadline = loop.time() + linger
+        while True:
+            log.info("writer_wrapper[%s]: %s", len(writers), payload)
+            await asyncio.gather(*[writer(payload) for writer in writers])
+            if not batch_writers or len(batch) >= batch_size:
+                break
+            try:
+                payload = await asyncio.wait_for(
+                    queue.get(), timeout=max(0.0, deadline - loop.time())
+                )
+            except asyncio.TimeoutError:
+                break
+            batch.append(payload)
+        if batch_writers:
+            log.info("writer_wrapper[%s]: batch of %i", len(batch_writers), len(batch))
+            await asyncio.gather(*[writer(batch) for writer in batch_writers])
 
 
 async def console_writer(payload: ConsumerPayload):
@@ -233,6 +366,9 @@ async def consumer_loop(
     topic: str,
     ssl_context: SSLContext,
     writers: List[Callable[[ConsumerPayload], Awaitable[int]]],
+    batch_writers: Optional[
+        List[Callable[[List[ConsumerPayload]], Awaitable[int]]]
+    ] = None,
 ) -> int:
     """consume web data from kafka topic and distributes it to writers
 
@@ -240,21 +376,30 @@ async def consumer_loop(
         uri: kafka service uri
         topic: kafka topic
         ssl_context: instance of ssl.SSLContext
-        writers: means for egressing data from application.
+        writers: means for egressing data from application, called per payload.
+        batch_writers: as for writers but called with lists of payloads, see
+            writer_wrapper.
     """
     log.info("consumer: starting")
-    if len(writers) < 1:
+    use_eager_tasks()
+    if len(writers) + len(batch_writers or []) < 1:
         raise ValueError("there must be at least one writer passed to consumer_loop.")
-    queue: asyncio.Queue[ConsumerPayload] = asyncio.Queue()
+    queue: asyncio.Queue[ConsumerPayload] = asyncio.Queue(maxsize=DEFAULT_QUEUE_SIZE)
     async with AIOKafkaConsumer(
         topic,
         bootstrap_servers=uri,
         security_protocol="SSL",
         ssl_context=ssl_context,
         group_id=DEFAULT_GROUP_ID,
+        # bigger fetches amortize the round trip across more messages
+        fetch_max_bytes=52428800,
+        max_partition_fetch_bytes=10485760,
+        fetch_min_bytes=1024,
+        fetch_max_wait_ms=100,
     ) as consumer:
         await asyncio.gather(
-            decoder(queue, consumer), writer_wrapper(queue=queue, writers=writers)
+            decoder(queue, consumer),
+            writer_wrapper(queue=queue, writers=writers, batch_writers=batch_writers),
         )
         log.info("consumer: exiting")
     return 0
@@ -266,9 +411,13 @@ async def round_trip_loop(
     ssl_context: SSLContext,
     collectors: List[Callable[[], Awaitable[PageMetrics]]],
     writers: List[Callable[[ConsumerPayload], Awaitable[int]]],
+    batch_writers: Optional[
+        List[Callable[[List[ConsumerPayload]], Awaitable[int]]]
+    ] = None,
     interval: int = DEFAULT_INTERVAL,
 ) -> int:
     """fire up producer and consumer in the same process"""
+    use_eager_tasks()
     result = await asyncio.gather(
         producer_loop(
             uri=uri,
@@ -277,7 +426,13 @@ async def round_trip_loop(
             interval=interval,
             collectors=collectors,
         ),
-        consumer_loop(uri=uri, topic=topic, ssl_context=ssl_context, writers=writers),
+        consumer_loop(
+            uri=uri,
+            topic=topic,
+            ssl_context=ssl_context,
+            writers=writers,
+            batch_writers=batch_writers,
+        ),
     )
     log.info(result)
     return 0